@@ -0,0 +1,319 @@
+import os
+import gzip
+import shutil
+import logging
+import logging.handlers
+import threading
+import time
+import sys
+
+LOG_FORMAT = '%(asctime)s %(scene)s %(levelname)-8s %(message)s'
+LOG_DATEFMT = '%Y-%m-%d %H:%M:%S'
+MAIN_SCENE = 'main'
+
+# third-party loggers that can flood the logs during downloads and rtc
+NOISY_LOGGERS = [
+    'pyroSAR', 'spatialist', 'asf_search', 'botocore',
+    'boto3', 's3transfer', 'urllib3', 'rasterio'
+    ]
+
+
+def _gzip_namer(name):
+    return name + '.gz'
+
+def _gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def make_file_handler(log_path, max_bytes=0, backup_count=5, compress=False):
+    """Make a file handler, rotating the file once it exceeds max_bytes
+
+    Args:
+        log_path (str): path to the log file
+        max_bytes (int, optional): rotate the file above this size. Defaults to 0 (no rotation).
+        backup_count (int, optional): number of rotated files to keep. Defaults to 5.
+        compress (bool, optional): gzip rotated files. Defaults to False.
+
+    Returns:
+        logging.Handler: the file handler
+    """
+    if not max_bytes:
+        return logging.FileHandler(log_path)
+    handler = logging.handlers.RotatingFileHandler(
+        log_path, maxBytes=max_bytes, backupCount=backup_count)
+    if compress:
+        handler.namer = _gzip_namer
+        handler.rotator = _gzip_rotator
+    return handler
+
+
+class SceneFilter(logging.Filter):
+    """Tag records with the scene being processed and drop records
+    below the level set for that scene. Installed on the worker's
+    queue handler so filtered records are never pickled or queued.
+    """
+
+    def __init__(self, scene=MAIN_SCENE, level=logging.INFO):
+        super().__init__()
+        self.scene = scene
+        self.level = level
+
+    def filter(self, record):
+        if not hasattr(record, 'scene'):
+            record.scene = self.scene
+        return record.levelno >= self.level
+
+
+class RateLimitFilter(logging.Filter):
+    """Limit the number of records per second from each noisy logger,
+    counting its child loggers with it. Warnings and errors are always
+    let through. The number of records dropped is reported, per noisy
+    logger, on the next record let through from any logger.
+    """
+
+    def __init__(self, loggers, rate=20):
+        super().__init__()
+        self.loggers = tuple(loggers)
+        self.rate = rate
+        self._windows = {}
+        self._dropped = {}
+
+    def _noisy_logger(self, record):
+        # the configured logger the record comes from, if any
+        name = record.name
+        for l in self.loggers:
+            if name == l or name.startswith(l + '.'):
+                return l
+        return None
+
+    def filter(self, record):
+        noisy = self._noisy_logger(record) if self.rate and (record.levelno < logging.WARNING) else None
+        if noisy is not None:
+            # child loggers share the limit of the configured logger
+            now = int(time.monotonic())
+            window, count = self._windows.get(noisy, (now, 0))
+            if window != now:
+                window, count = now, 0
+            if count >= self.rate:
+                self._windows[noisy] = (window, count)
+                self._dropped[noisy] = self._dropped.get(noisy, 0) + 1
+                return False
+            self._windows[noisy] = (window, count + 1)
+        if self._dropped:
+            suppressed = ', '.join(f'{n} from {name}' for name, n in self._dropped.items())
+            record.msg = f'{record.msg} (records suppressed: {suppressed})'
+            self._dropped = {}
+        return True
+
+
+class SceneFileHandler(logging.Handler):
+    """Write each record to the log file of the scene it belongs to,
+    i.e. {log_dir}/{scene}.logs. Runs in the listener thread of the
+    parent process.
+    """
+
+    def __init__(self, log_dir):
+        super().__init__()
+        self.log_dir = log_dir
+        self._handlers = {}
+        self._closed = set()
+
+    def log_path(self, scene):
+        return os.path.join(self.log_dir, scene + '.logs')
+
+    def emit(self, record):
+        scene = getattr(record, 'scene', MAIN_SCENE)
+        if (scene == MAIN_SCENE) or (scene in self._closed):
+            # records arriving after a scene's log was closed (and possibly
+            # uploaded) are only kept in the run log
+            return
+        handler = self._handlers.get(scene)
+        if handler is None:
+            # scene logs are not rotated so the uploaded file is complete
+            handler = logging.FileHandler(self.log_path(scene), mode='w')
+            handler.setFormatter(self.formatter)
+            self._handlers[scene] = handler
+        handler.emit(record)
+
+    def close_scene(self, scene):
+        self._closed.add(scene)
+        handler = self._handlers.pop(scene, None)
+        if handler is not None:
+            handler.close()
+
+    def close(self):
+        for scene in list(self._handlers):
+            self._handlers.pop(scene).close()
+        super().close()
+
+
+class _CloseSceneHandler(logging.Handler):
+    """Close a scene's log file when a close request for it comes through
+    the queue. As the queue is FIFO, all records put by the scene's
+    worker have been written by then.
+    """
+
+    def __init__(self, scene_handler):
+        super().__init__()
+        self.scene_handler = scene_handler
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def event(self, scene):
+        with self._lock:
+            return self._events.setdefault(scene, threading.Event())
+
+    def emit(self, record):
+        scene = getattr(record, 'close_scene', None)
+        if scene is None:
+            return
+        self.scene_handler.close_scene(scene)
+        self.event(scene).set()
+
+
+def _close_record(scene):
+    # request for the listener to close the log of a scene
+    return logging.makeLogRecord({
+        'msg': f'closing log for {scene}',
+        'levelno': logging.INFO,
+        'levelname': 'INFO',
+        'scene': MAIN_SCENE,
+        'close_scene': scene})
+
+
+class _NotCloseFilter(logging.Filter):
+    def filter(self, record):
+        return not hasattr(record, 'close_scene')
+
+
+class LogListener:
+    """Single listener in the parent process that writes records put
+    on a queue by the workers (and the parent itself) to the per-scene
+    log files, a run log and stdout.
+
+    Args:
+        queue: a queue shared with the workers, e.g. multiprocessing.Queue()
+        log_dir (str): folder for the scene and run logs
+        run_log (str, optional): name of the run log. Defaults to 'run.logs'.
+        max_bytes (int, optional): rotate the run log above this size. Defaults to 0 (no rotation).
+        backup_count (int, optional): number of rotated run logs to keep. Defaults to 5.
+        compress (bool, optional): gzip rotated run logs. Defaults to False.
+    """
+
+    def __init__(self, queue, log_dir, run_log='run.logs',
+                 max_bytes=0, backup_count=5, compress=False):
+        self.queue = queue
+        os.makedirs(log_dir, exist_ok=True)
+        formatter = logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATEFMT)
+
+        self.scene_handler = SceneFileHandler(log_dir)
+        run_handler = make_file_handler(
+            os.path.join(log_dir, run_log), max_bytes, backup_count, compress)
+        stream_handler = logging.StreamHandler(sys.stdout)
+        handlers = [self.scene_handler, run_handler, stream_handler]
+        for handler in handlers:
+            handler.setFormatter(formatter)
+            handler.addFilter(_NotCloseFilter())
+        self._close_handler = _CloseSceneHandler(self.scene_handler)
+        handlers.append(self._close_handler)
+
+        self._listener = logging.handlers.QueueListener(
+            queue, *handlers, respect_handler_level=True)
+
+    def log_path(self, scene):
+        return self.scene_handler.log_path(scene)
+
+    def start(self):
+        self._listener.start()
+
+    def stop(self):
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+
+    def close_scene(self, scene, timeout=60):
+        """Wait for all records of a scene to be written and its log file
+        closed, e.g. before uploading it. The log is closed when the close
+        request sent by the worker at the end of the scene (end_log_scene)
+        comes through the queue. If it does not arrive, e.g. as the worker
+        died, the log is closed from here.
+
+        Args:
+            scene (str): the scene
+            timeout (int, optional): seconds to wait. Defaults to 60.
+
+        Returns:
+            str: path to the scene log file
+        """
+        event = self._close_handler.event(scene)
+        if not event.wait(timeout):
+            logging.warning(f'Timed out waiting for logs of {scene} to be written')
+            self.queue.put_nowait(_close_record(scene))
+            event.wait(timeout)
+        return self.log_path(scene)
+
+
+def setup_queue_logging(queue, level=logging.INFO):
+    """Route all records of the current process through a queue handler.
+    Used by the parent process and as the initializer of each worker. Putting
+    a record on a multiprocessing.Queue only hands it to a feeder thread, so
+    logging I/O stays off the worker's critical path.
+
+    Args:
+        queue: the queue read by the LogListener
+        level (int, optional): level for records not belonging to a scene. Defaults to logging.INFO.
+    """
+    log = logging.getLogger()
+    for hdlr in log.handlers[:]:
+        log.removeHandler(hdlr)
+    queue_handler = logging.handlers.QueueHandler(queue)
+    queue_handler.addFilter(SceneFilter(MAIN_SCENE, level))
+    log.setLevel(level)
+    log.addHandler(queue_handler)
+
+
+def set_log_scene(scene, level=logging.INFO, rate_limit=20, noisy_loggers=NOISY_LOGGERS):
+    """Attribute all following records of this process to a scene. Sets the
+    level of the scene and rate limits noisy third-party loggers. Filtering
+    happens before records are queued to keep the worker's overhead low.
+
+    Args:
+        scene (str): the scene being processed
+        level (int|str, optional): level for the scene's records. Defaults to logging.INFO.
+        rate_limit (int, optional): max records per second from each noisy logger. 0 disables. Defaults to 20.
+        noisy_loggers (list, optional): names of the loggers to rate limit. Defaults to NOISY_LOGGERS.
+    """
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+    log = logging.getLogger()
+    # records below the scene level are then never created
+    log.setLevel(level)
+    for hdlr in log.handlers:
+        if not isinstance(hdlr, logging.handlers.QueueHandler):
+            continue
+        for filt in hdlr.filters[:]:
+            hdlr.removeFilter(filt)
+        hdlr.addFilter(SceneFilter(scene, level))
+        hdlr.addFilter(RateLimitFilter(noisy_loggers, rate_limit))
+
+
+def end_log_scene(scene):
+    """End the scene of this process. Reports records of noisy loggers
+    suppressed at the end of the scene and asks the listener to close the
+    scene's log once the records before it are written. Call before the
+    scene's result is returned.
+
+    Args:
+        scene (str): the scene being processed
+    """
+    log = logging.getLogger()
+    for hdlr in log.handlers:
+        if any(isinstance(f, RateLimitFilter) and f._dropped for f in hdlr.filters):
+            # the counts are appended to this record by the rate limit filter
+            logging.getLogger(__name__).warning('noisy loggers were rate limited')
+            break
+    for hdlr in log.handlers:
+        if isinstance(hdlr, logging.handlers.QueueHandler):
+            # put on the queue directly, bypassing the scene filters
+            hdlr.enqueue(_close_record(scene))
@@ -10,36 +10,94 @@ from etad import *
 import time
 import shutil
 from pyroSAR.snap import geocode
+import pyroSAR.snap.auxil as snap_auxil
+from pyroSAR import identify
 from pyproj import CRS
 from pyproj.aoi import AreaOfInterest
 from pyproj.database import query_utm_crs_info
 import json
-import sys
 from dem_handler.dem.cop_glo30 import get_cop30_dem_for_bounds
 from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import multiprocessing.util
 import traceback
-
-
-def setup_logging(log_path):
-    # Get the root logger and remove any inherited handlers
-    log = logging.getLogger()
-    for hdlr in log.handlers[:]:
-        log.removeHandler(hdlr)
-
-    # Create new handlers
-    logging_file_handler = logging.FileHandler(log_path, mode="w")
-    logging_stream_handler = logging.StreamHandler(sys.stdout)
-
-    formatter = logging.Formatter(
-        fmt='%(asctime)s %(levelname)-8s %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    logging_file_handler.setFormatter(formatter)
-    logging_stream_handler.setFormatter(formatter)
-
-    log.setLevel(logging.INFO)
-    log.addHandler(logging_file_handler)
-    log.addHandler(logging_stream_handler)
+from logging_utils import *
+from snap_engine import SnapEngine
+from scene_search import find_new_scenes, record_completed
+
+# long-lived SNAP engine of this worker, used when rtc_backend is 'warm'
+_snap_engine = None
+
+def get_snap_engine(otf_cfg):
+    global _snap_engine
+    if _snap_engine is None:
+        _snap_engine = SnapEngine(
+            command=otf_cfg['snap_engine_command'],
+            gpt_args=otf_cfg['gpt_args'],
+            cache_size=otf_cfg['snap_cache_size'],
+            threads=otf_cfg['snap_threads'],
+            timeout=otf_cfg['snap_engine_timeout'])
+        # pool workers exit with os._exit, which skips atexit but
+        # runs the multiprocessing finalizers
+        multiprocessing.util.Finalize(None, _snap_engine.stop, exitpriority=10)
+    return _snap_engine
+
+def run_workflow_warm(snap_engine, wf_name, outdir, clean_edges=True, gpt_args=None):
+    """Run a workflow written by pyroSAR.snap.geocode(test=True) on the warm
+    SNAP engine, followed by the steps geocode runs after gpt: converting the
+    output to the final GeoTIFFs (with edge cleaning and nodata values) and
+    deleting the temporary files. As in geocode, the workflow is split into
+    one sub-workflow per operator. Scenes needing pyroSAR's custom GRD border
+    noise removal (IPF < 2.9) are run with pyroSAR's gpt instead.
+
+    Args:
+        snap_engine (SnapEngine): the engine of this worker
+        wf_name (str): path to the workflow xml
+        outdir (str): directory for the final products
+        clean_edges (bool, optional): erode noisy image edges. Defaults to True.
+        gpt_args (list, optional): arguments for gpt if it is used. Defaults to None.
+
+    Returns:
+        tuple: (seconds spent running the graphs, engine state 'cold', 'warm' or 'gpt')
+    """
+    workflow = snap_auxil.Workflow(wf_name)
+    tmpdir = workflow['Write'].parameters['file']
+    groups = snap_auxil.groupbyWorkers(wf_name, 1)
+    custom_bnr = ('Remove-GRD-Border-Noise' in workflow.ids) and \
+        (identify(workflow['Read'].parameters['file']).meta['IPF_version'] < 2.9)
+
+    graph_time = 0
+    engine_state = None
+    try:
+        if custom_bnr:
+            logging.warning('pyroSAR border noise removal required, running the workflow with gpt')
+            t0 = time.time()
+            snap_auxil.gpt(wf_name, tmpdir=tmpdir, groups=groups, gpt_args=gpt_args)
+            graph_time = time.time() - t0
+            engine_state = 'gpt'
+        else:
+            subs = snap_auxil.split(wf_name, groups, outdir=os.path.join(tmpdir, 'sub'))
+            for sub in subs:
+                sub_time, warm = snap_engine.run(sub)
+                graph_time += sub_time
+                if engine_state is None:
+                    engine_state = 'warm' if warm else 'cold'
+        snap_auxil.writer(xmlfile=wf_name, outdir=outdir, clean_edges=clean_edges)
+    finally:
+        if os.path.isdir(tmpdir):
+            logging.info('deleting temporary files')
+            shutil.rmtree(tmpdir)
+    return graph_time, engine_state
+
+
+def set_aws_credentials(credentials_path):
+    logging.info(f'setting aws credentials from : {credentials_path}')
+    with open(credentials_path, "r", encoding='utf8') as f:
+        aws_cfg = yaml.safe_load(f.read())
+        # set all keys as environment variables
+        for k in aws_cfg.keys():
+            logging.info(f'setting {k}')
+            os.environ[k] = aws_cfg[k]
 
 def run_process(config, scene):
 
@@ -52,25 +110,24 @@ def run_process(config, scene):
     SCENE_OUT_FOLDER = os.path.join(OUT_FOLDER,scene)
     os.makedirs(SCENE_OUT_FOLDER, exist_ok=True)
     
-    #setup logging
-    log_path = os.path.join(OUT_FOLDER,scene+'.logs')
-
-    # create a haandler to write to file and stdout/console
-    setup_logging(log_path)
+    # attribute logs to the scene, these are written to {OUT_FOLDER}/{scene}.logs
+    # by the log listener in the main process
+    log_levels = otf_cfg['log_scene_levels'] or {}
+    set_log_scene(
+        scene,
+        level=log_levels.get(scene, otf_cfg['log_level']),
+        rate_limit=otf_cfg['log_rate_limit'],
+        noisy_loggers=otf_cfg['log_rate_limited_loggers'])
 
     timing = {}
+    # non-numeric details of the run, kept out of the timing durations
+    timing_meta = {}
     t0 = time.time()
 
     logging.info(f'PROCESS 1: Downloads')
     
     # read in aws credentials and set as environ vars
-    logging.info(f'setting aws credentials from : {otf_cfg["aws_credentials"]}')
-    with open(otf_cfg['aws_credentials'], "r", encoding='utf8') as f:
-        aws_cfg = yaml.safe_load(f.read())
-        # set all keys as environment variables
-        for k in aws_cfg.keys():
-            logging.info(f'setting {k}')
-            os.environ[k] = aws_cfg[k]
+    set_aws_credentials(otf_cfg['aws_credentials'])
         
     # set parameters to limit search results to single scene
     level = scene.split('_')[2]
@@ -228,8 +285,10 @@ def run_process(config, scene):
     if otf_cfg['snap_path'] not in os.environ['PATH']:
         os.environ['PATH'] = os.environ['PATH'] + ':' + otf_cfg['snap_path']
 
+    # with the warm backend pyroSAR only writes the workflow xml, which is
+    # then run on this worker's long-lived SNAP engine and post-processed
+    warm_backend = otf_cfg['rtc_backend'] == 'warm'
     logging.info(f'Performing RTC on file : {applied_scene_file}')
-    logging.getLogger().setLevel(logging.DEBUG)
     scene_workflow = geocode(infile=applied_scene_file,
         outdir=SCENE_OUT_FOLDER,
         allow_RES_OSV=True,
@@ -244,8 +303,19 @@ def run_process(config, scene):
         terrainFlattening=otf_cfg['pyrosar_terrainFlattening'],
         export_extra=otf_cfg['pyrosar_export_extra'],
         gpt_args=otf_cfg['gpt_args'],
+        test=warm_backend,
         )
-    logging.getLogger().setLevel(logging.INFO)
+    timing_meta['RTC Engine'] = 'gpt'
+    if warm_backend and (scene_workflow is not None):
+        graph_time, engine_state = run_workflow_warm(
+            get_snap_engine(otf_cfg),
+            scene_workflow,
+            SCENE_OUT_FOLDER,
+            clean_edges=True,
+            gpt_args=otf_cfg['gpt_args'])
+        timing_meta['RTC Engine'] = engine_state
+        timing['RTC Graph'] = graph_time
+        logging.info(f'Process graph run on {engine_state} SNAP engine in {graph_time:.1f}s')
 
     error_files = find_files(SCENE_OUT_FOLDER, 'error')
     if len(error_files) > 0:
@@ -285,6 +355,7 @@ def run_process(config, scene):
 
     t4 = time.time()
     timing['RTC Processing'] = t4 - t3
+    logging.info(f'RTC time: {timing["RTC Processing"]:.1f}s ({timing_meta["RTC Engine"]} engine)')
 
     if otf_cfg['push_to_s3']:
         logging.info(f'PROCESS 3: Push results to S3 bucket')
@@ -359,34 +430,42 @@ def run_process(config, scene):
     logging.info(f'Elapsed time: {((time.time() - t0)/60)} minutes')
     timing['Total'] = t6 - t0
     
-    # save timing file
+    # save timing files
     timing_file = SCENE_NAME + '_timing.json'
     with open(timing_file, 'w') as fp:
             json.dump(timing, fp)
+    timing_meta_file = SCENE_NAME + '_timing_meta.json'
+    with open(timing_meta_file, 'w') as fp:
+            json.dump(timing_meta, fp)
     
-    # push timings + logs to s3
+    # push timings to s3, logs are pushed by the main process
+    # once the log listener has written them
+    log_bucket_path = None
     if otf_cfg['push_to_s3']:
-        bucket_path = os.path.join(bucket_folder, timing_file)
-        logging.info(f'Uploading file: {timing_file}')
-        logging.info(f'Destination: {bucket_path}')
-        upload_file(file_name=timing_file, 
-                    bucket=bucket, 
-                    object_name=bucket_path)
-        _, log_file = os.path.split(log_path)
-        bucket_path = os.path.join(bucket_folder, f'{scene}.logs')
-        upload_file(file_name=log_path, 
-                    bucket=bucket, 
-                    object_name=bucket_path)
-        os.remove(timing_file)
+        # the timing file is pushed last, it marks the scene as complete
+        for file_ in [timing_meta_file, timing_file]:
+            bucket_path = os.path.join(bucket_folder, file_)
+            logging.info(f'Uploading file: {file_}')
+            logging.info(f'Destination: {bucket_path}')
+            upload_file(file_name=file_, 
+                        bucket=bucket, 
+                        object_name=bucket_path)
+            os.remove(file_)
+        log_bucket_path = os.path.join(bucket_folder, f'{scene}.logs')
+
+    return log_bucket_path
     
 
 def process_scene(config_path, scene):
     try:
-        run_process(config_path, scene)
-        return (scene, True, None)
+        log_bucket_path = run_process(config_path, scene)
+        return (scene, True, None, log_bucket_path)
     except Exception as e:
         tb_str = traceback.format_exc()
-        return (scene, False, tb_str)
+        logging.error(f'Scene {scene} failed with traceback:\n{tb_str}')
+        return (scene, False, tb_str, None)
+    finally:
+        end_log_scene(scene)
 
 if __name__ == "__main__":
     
@@ -403,27 +482,64 @@ if __name__ == "__main__":
     with open(args.config, 'r', encoding='utf8') as fin:
         otf_cfg = yaml.safe_load(fin.read())
 
-    # loop through the list of scenes
-    # download data -> produce backscatter -> save
-    scenes = otf_cfg['scenes']
-    n_parallel = otf_cfg['n_parallel']
-    logging.info(f'Starting processing with {n_parallel} parallel workers')
-
-    with ProcessPoolExecutor(max_workers=n_parallel) as executor:
-        futures = [executor.submit(process_scene, args.config, scene) for scene in scenes]
-        for future in as_completed(futures):
-            scene, ok, tb = future.result()
-            if ok:
-                success['pyrosar-rtc'].append(scene)
-            else:
-                failed['pyrosar-rtc'].append(scene)
-                logging.error(f"Scene {scene} failed with traceback:\n{tb}")
-
-    logging.info(f'Run complete, attempted to process {len(otf_cfg["scenes"])} scenes')
-    logging.info(f'{len(success["pyrosar-rtc"])} scenes successfully processed: ')
-    for s in success['pyrosar-rtc']:
-        logging.info(f'{s}')
-    logging.info(f'{len(failed["pyrosar-rtc"])} scenes FAILED: ')
-    for s in failed['pyrosar-rtc']:
-        logging.info(f'{s}')
-    logging.info(f'Elapsed time:  {((time.time() - t_start)/60)} minutes')
+    # route logs from the main process and all workers through a queue to a
+    # single listener that writes the scene logs, the run log and stdout
+    log_queue = multiprocessing.Queue(-1)
+    log_listener = LogListener(
+        log_queue,
+        otf_cfg['pyrosar_output_folder'],
+        max_bytes=otf_cfg['log_max_bytes'],
+        backup_count=otf_cfg['log_backup_count'],
+        compress=otf_cfg['log_compress'])
+    log_listener.start()
+    setup_queue_logging(log_queue)
+
+    try:
+        # credentials for pushing the scene logs (and listing the bucket in incremental mode)
+        set_aws_credentials(otf_cfg['aws_credentials'])
+
+        # in incremental mode search for the scenes over the aoi and only
+        # process those not yet completed, otherwise use the list of scenes
+        if otf_cfg['search_aoi']:
+            scenes = find_new_scenes(otf_cfg)
+        else:
+            scenes = otf_cfg['scenes']
+
+        # loop through the list of scenes
+        # download data -> produce backscatter -> save
+        n_parallel = otf_cfg['n_parallel']
+        logging.info(f'Starting processing with {n_parallel} parallel workers')
+
+        with ProcessPoolExecutor(
+            max_workers=n_parallel,
+            initializer=setup_queue_logging,
+            initargs=(log_queue,)) as executor:
+            futures = [executor.submit(process_scene, args.config, scene) for scene in scenes]
+            for future in as_completed(futures):
+                scene, ok, tb, log_bucket_path = future.result()
+                if ok:
+                    success['pyrosar-rtc'].append(scene)
+                    record_completed(otf_cfg, scene)
+                else:
+                    failed['pyrosar-rtc'].append(scene)
+                    logging.error(f"Scene {scene} failed, see {log_listener.log_path(scene)}")
+                # wait for the scene logs to be written before pushing
+                log_path = log_listener.close_scene(scene)
+                if log_bucket_path is not None:
+                    try:
+                        upload_file(file_name=log_path, 
+                                    bucket=otf_cfg['s3_bucket'], 
+                                    object_name=log_bucket_path)
+                    except Exception as e:
+                        logging.error(f'Failed to upload logs for {scene}: {e}')
+
+        logging.info(f'Run complete, attempted to process {len(scenes)} scenes')
+        logging.info(f'{len(success["pyrosar-rtc"])} scenes successfully processed: ')
+        for s in success['pyrosar-rtc']:
+            logging.info(f'{s}')
+        logging.info(f'{len(failed["pyrosar-rtc"])} scenes FAILED: ')
+        for s in failed['pyrosar-rtc']:
+            logging.info(f'{s}')
+        logging.info(f'Elapsed time:  {((time.time() - t_start)/60)} minutes')
+    finally:
+        log_listener.stop()
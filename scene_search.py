@@ -0,0 +1,149 @@
+import os
+import json
+import logging
+import boto3
+import asf_search as asf
+from shapely.geometry import shape
+from shapely.ops import unary_union
+from shapely import wkt
+
+logger = logging.getLogger(__name__)
+
+def list_bucket_files(bucket, prefix=''):
+    """List all files in an S3 bucket under a prefix
+
+    :param bucket: Bucket to list
+    :param prefix: Only list files starting with this prefix
+    :return: List of object names
+    """
+    s3_client = boto3.client('s3')
+    paginator = s3_client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+    return keys
+
+def load_aoi(aoi):
+    """Load an area of interest as WKT
+
+    Args:
+        aoi (str): path to a geojson file or a WKT geometry
+
+    Returns:
+        str: WKT of the aoi, features in a geojson are merged
+    """
+    if os.path.splitext(aoi)[1].lower() in ['.geojson', '.json']:
+        if not os.path.exists(aoi):
+            raise FileNotFoundError(f'aoi file not found: {aoi}')
+    elif not os.path.exists(aoi):
+        try:
+            return wkt.loads(aoi).wkt
+        except Exception as e:
+            raise ValueError(f'aoi is not an existing file or a valid WKT geometry: {aoi}') from e
+    with open(aoi, 'r', encoding='utf8') as f:
+        geojson = json.load(f)
+    if geojson['type'] == 'FeatureCollection':
+        geoms = [shape(f['geometry']) for f in geojson['features']]
+    elif geojson['type'] == 'Feature':
+        geoms = [shape(geojson['geometry'])]
+    else:
+        geoms = [shape(geojson)]
+    return unary_union(geoms).wkt
+
+def search_scenes(otf_cfg):
+    """Search asf for all scenes over the aoi in the date range
+
+    Args:
+        otf_cfg (dict): the otf config, see search_* settings
+
+    Returns:
+        list: scene names sorted by acquisition time
+    """
+    aoi = load_aoi(otf_cfg['search_aoi'])
+    logger.info(f'searching asf for scenes between {otf_cfg["search_start_date"]} and {otf_cfg["search_end_date"]}')
+    logger.info(f'aoi: {aoi}')
+    asf.constants.CMR_TIMEOUT = 45
+    # results are paged through by asf_search
+    asf_results = asf.geo_search(
+        intersectsWith=aoi,
+        platform=asf.PLATFORM.SENTINEL1,
+        start=str(otf_cfg['search_start_date']),
+        end=str(otf_cfg['search_end_date']),
+        beamMode=otf_cfg['search_beam_mode'],
+        processingLevel=otf_cfg['search_processing_level'],
+        polarization=otf_cfg['search_polarisation'])
+    start_times = {r.properties['sceneName']: r.properties['startTime'] for r in asf_results}
+    scenes = sorted(start_times, key=start_times.get)
+    logger.info(f'{len(scenes)} scenes found on asf')
+    return scenes
+
+def _ledger_prefix(otf_cfg):
+    # ledger entries are scoped like the bucket prefix, software/dem_type/scene,
+    # so runs with different settings can share a ledger
+    return f'{otf_cfg["software"]}/{otf_cfg["dem_type"]}/'
+
+def record_completed(otf_cfg, scene):
+    """Add a successfully processed scene to the completion ledger, if set.
+    Failing to write the ledger is logged and does not stop the run.
+
+    Args:
+        otf_cfg (dict): the otf config
+        scene (str): the processed scene
+    """
+    ledger = otf_cfg['completion_ledger']
+    if not ledger:
+        return
+    try:
+        with open(ledger, 'a', encoding='utf8') as f:
+            f.write(_ledger_prefix(otf_cfg) + scene + '\n')
+    except OSError as e:
+        logger.error(f'Failed to add {scene} to the completion ledger {ledger}: {e}')
+
+def completed_scenes(otf_cfg):
+    """Find scenes that have already been processed. These are the scenes
+    in the completion ledger and scenes with a timing file (the last file
+    pushed for a scene) under the software/dem_type prefix in the s3 bucket
+
+    Args:
+        otf_cfg (dict): the otf config
+
+    Returns:
+        set: the completed scene names
+    """
+    completed = set()
+    ledger = otf_cfg['completion_ledger']
+    if ledger and os.path.exists(ledger):
+        prefix = _ledger_prefix(otf_cfg)
+        with open(ledger, 'r', encoding='utf8') as f:
+            completed.update(
+                line.strip()[len(prefix):] for line in f if line.startswith(prefix))
+        logger.info(f'{len(completed)} scenes in completion ledger: {ledger}')
+    if otf_cfg['push_to_s3']:
+        S3_BUCKET_FOLDER = '' if otf_cfg["s3_bucket_folder"] == None else otf_cfg["s3_bucket_folder"]
+        bucket_prefix = os.path.join(
+            S3_BUCKET_FOLDER,
+            otf_cfg['software'],
+            otf_cfg['dem_type'], '')
+        logger.info(f'listing processed scenes in s3://{otf_cfg["s3_bucket"]}/{bucket_prefix}')
+        bucket_scenes = set(
+            os.path.basename(k).replace('_timing.json', '')
+            for k in list_bucket_files(otf_cfg['s3_bucket'], bucket_prefix)
+            if k.endswith('_timing.json'))
+        logger.info(f'{len(bucket_scenes)} scenes found in s3 bucket')
+        completed.update(bucket_scenes)
+    return completed
+
+def find_new_scenes(otf_cfg):
+    """Search for scenes over the aoi and drop those already processed
+
+    Args:
+        otf_cfg (dict): the otf config
+
+    Returns:
+        list: scenes to process, sorted by acquisition time
+    """
+    found_scenes = search_scenes(otf_cfg)
+    done_scenes = completed_scenes(otf_cfg)
+    scenes = [s for s in found_scenes if s not in done_scenes]
+    logger.info(f'{len(found_scenes) - len(scenes)} scenes already processed, {len(scenes)} new scenes')
+    return scenes
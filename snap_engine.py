@@ -0,0 +1,277 @@
+import os
+import sys
+import time
+import shlex
+import tempfile
+import logging
+import queue
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+# prefix of the lines the engine server replies with. Anything else
+# written to stdout (e.g. by SNAP) is passed on to the logs
+REPLY_PREFIX = 'SNAP_ENGINE'
+
+
+class SnapEngineError(RuntimeError):
+    pass
+
+
+class SnapEngine:
+    """Long-lived SNAP process that executes graph xml files, keeping the
+    JVM, the SNAP modules and the tile cache warm between scenes. Graphs
+    are sent one path per line on stdin and the process replies with a
+    line "SNAP_ENGINE OK <seconds>" or "SNAP_ENGINE ERROR <message>".
+    Other output on stdout and stderr is logged at debug level. The
+    process is restarted if it crashes, or killed and restarted if a
+    graph takes longer than the timeout.
+
+    Args:
+        command (list|str, optional): command to start the engine server. Defaults to
+            running this module with the current python, which requires esa_snappy.
+        gpt_args (list, optional): gpt style arguments, applied as jvm options when the
+            engine starts, e.g. ['-Djava.io.tmpdir=/data/tmp']. Defaults to None.
+        cache_size (str, optional): tile cache size, e.g. '8G'. Defaults to None (SNAP default).
+        threads (int, optional): number of SNAP threads. Defaults to None (SNAP default).
+        retries (int, optional): times a graph is resubmitted after a crash. Defaults to 1.
+        timeout (float, optional): seconds a graph may take before the engine is considered
+            hung. Defaults to None (no timeout).
+    """
+
+    def __init__(self, command=None, gpt_args=None, cache_size=None, threads=None,
+                 retries=1, timeout=None):
+        if command is None:
+            command = [sys.executable, os.path.abspath(__file__)]
+        elif isinstance(command, str):
+            command = shlex.split(command)
+        self.command = list(command)
+        self.gpt_args = list(gpt_args or [])
+        if cache_size:
+            self.gpt_args += ['-c', str(cache_size)]
+        if threads:
+            self.gpt_args += ['-q', str(threads)]
+        self.retries = retries
+        self.timeout = timeout
+        self.restarts = 0
+        self._proc = None
+        self._stdout = None
+        self._n_runs = 0
+
+    @property
+    def running(self):
+        return (self._proc is not None) and (self._proc.poll() is None)
+
+    def start(self):
+        """start the engine server if it is not running"""
+        if self.running:
+            return
+        if self._proc is not None:
+            logger.warning(f'SNAP engine exited with code {self._proc.returncode}, restarting')
+            self.restarts += 1
+        cmd = self.command + self.gpt_args
+        logger.info(f'Starting SNAP engine: {" ".join(cmd)}')
+        self._proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1)
+        # pass SNAP/java errors on to the logs of the scene being processed
+        threading.Thread(target=self._log_stderr, args=(self._proc.stderr,), daemon=True).start()
+        # stdout is read in a thread so replies can be waited for with a timeout
+        self._stdout = queue.Queue()
+        threading.Thread(
+            target=self._read_stdout, args=(self._proc.stdout, self._stdout), daemon=True).start()
+        self._n_runs = 0
+
+    @staticmethod
+    def _log_stderr(stderr):
+        for line in stderr:
+            logger.debug(line.rstrip('\n'))
+
+    @staticmethod
+    def _read_stdout(stdout, lines):
+        for line in stdout:
+            lines.put(line.rstrip('\n'))
+        # stdout closed, the process has exited
+        lines.put(None)
+
+    def stop(self):
+        """stop the engine server"""
+        if self._proc is None:
+            return
+        if self.running:
+            self._proc.stdin.close()
+            try:
+                self._proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+                self._proc.wait()
+        self._proc = None
+
+    def _submit(self, xml_path):
+        try:
+            self._proc.stdin.write(xml_path + '\n')
+            self._proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return None
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+                line = self._stdout.get(timeout=remaining)
+            except queue.Empty:
+                logger.error(f'SNAP engine timed out after {self.timeout}s processing {xml_path}, killing it')
+                self._proc.kill()
+                break
+            if line is None:
+                # stdout closed, the process has crashed
+                break
+            if not line.startswith(REPLY_PREFIX):
+                logger.debug(line)
+                continue
+            return line[len(REPLY_PREFIX):].strip()
+        self._proc.wait()
+        return None
+
+    def run(self, xml_path):
+        """Execute a graph xml file
+
+        Args:
+            xml_path (str): path to the graph xml, e.g. written by pyroSAR.snap.geocode
+
+        Raises:
+            SnapEngineError: if the graph fails, or the engine keeps crashing or timing out
+
+        Returns:
+            tuple: (seconds taken by the graph, whether the engine was warm)
+        """
+        xml_path = os.path.abspath(xml_path)
+        for attempt in range(self.retries + 1):
+            self.start()
+            warm = self._n_runs > 0
+            reply = self._submit(xml_path)
+            if reply is None:
+                logger.error(f'SNAP engine stopped while processing {xml_path}')
+                continue
+            self._n_runs += 1
+            status, _, detail = reply.partition(' ')
+            if status != 'OK':
+                raise SnapEngineError(f'SNAP engine failed to process {xml_path}: {detail}')
+            return float(detail), warm
+        raise SnapEngineError(
+            f'SNAP engine crashed {self.retries + 1} times processing {xml_path}')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+
+def _parse_size(size):
+    # gpt style size in bytes, optionally suffixed with K, M or G
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    size = str(size).upper()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def jvm_config(gpt_args):
+    """Translate gpt command line arguments to jvm options for esa_snappy
+
+    Args:
+        gpt_args (list): gpt style arguments, e.g. ['-J-Xmx16G', '-c', '8G', '-q', '4', '-Djava.io.tmpdir=/data/tmp']
+
+    Returns:
+        tuple: (jvm options, max heap size or None, tile cache size in bytes or None)
+    """
+    java_options, max_mem, cache_size = [], None, None
+    args = list(gpt_args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('-J-Xmx'):
+            max_mem = arg[len('-J-Xmx'):]
+        elif arg.startswith('-J'):
+            java_options.append(arg[2:])
+        elif arg.startswith('-D'):
+            java_options.append(arg)
+        elif (arg == '-c') and args:
+            cache_size = _parse_size(args.pop(0))
+        elif (arg == '-q') and args:
+            java_options.append(f'-Dsnap.parallelism={args.pop(0)}')
+        else:
+            logger.warning(f'gpt argument not supported by the SNAP engine: {arg}')
+    return java_options, max_mem, cache_size
+
+def _write_snappy_ini(ini_dir, java_options, max_mem):
+    # esa_snappy creates the jvm on import with the options of its ini file,
+    # read from the module folder and then the working directory. Write a copy
+    # of the configured ini with the extra options to ini_dir
+    import configparser
+    import importlib.util
+    module_dir = os.path.dirname(os.path.realpath(importlib.util.find_spec('esa_snappy').origin))
+    module_ini = os.path.basename(module_dir) + '.ini'
+    config = configparser.ConfigParser(interpolation=None)
+    config.read([os.path.join(module_dir, module_ini),
+                 os.path.join(module_dir, '..', module_ini)])
+    defaults = config['DEFAULT']
+    if java_options:
+        existing = defaults.get('java_options')
+        defaults['java_options'] = '|'.join(([existing] if existing else []) + java_options)
+    if max_mem:
+        defaults['java_max_mem'] = max_mem
+    with open(os.path.join(ini_dir, module_ini), 'w') as f:
+        config.write(f)
+
+
+def serve(gpt_args=()):
+    """Run the engine server. Reads graph xml paths from stdin and executes
+    them in a single JVM using the SNAP graph processor. The gpt arguments
+    are applied once, as jvm options before the JVM is started.
+
+    Args:
+        gpt_args (list, optional): gpt style arguments (-J<option>, -D<key>=<value>, -c, -q). Defaults to ().
+    """
+    java_options, max_mem, cache_size = jvm_config(gpt_args)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as ini_dir:
+        _write_snappy_ini(ini_dir, java_options, max_mem)
+        os.chdir(ini_dir)
+        try:
+            from esa_snappy import jpy
+        finally:
+            os.chdir(cwd)
+
+    if cache_size:
+        JAI = jpy.get_type('javax.media.jai.JAI')
+        JAI.getDefaultInstance().getTileCache().setMemoryCapacity(cache_size)
+    FileReader = jpy.get_type('java.io.FileReader')
+    GraphIO = jpy.get_type('org.esa.snap.core.gpf.graph.GraphIO')
+    GraphProcessor = jpy.get_type('org.esa.snap.core.gpf.graph.GraphProcessor')
+    ProgressMonitor = jpy.get_type('com.bc.ceres.core.ProgressMonitor')
+
+    for line in sys.stdin:
+        xml_path = line.strip()
+        if not xml_path:
+            continue
+        t0 = time.time()
+        try:
+            reader = FileReader(xml_path)
+            try:
+                graph = GraphIO.read(reader)
+            finally:
+                reader.close()
+            GraphProcessor().executeGraph(graph, ProgressMonitor.NULL)
+            print(f'{REPLY_PREFIX} OK {time.time() - t0}', flush=True)
+        except Exception as e:
+            msg = str(e).replace('\n', ' ')
+            print(f'{REPLY_PREFIX} ERROR {msg}', flush=True)
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1:])
@@ -0,0 +1,29 @@
+"""Stand-in for the SNAP engine server, following the same stdin/stdout
+protocol without SNAP. The graph file name decides what happens:
+
+- containing 'fail': reply with an error
+- containing 'hang': never reply
+- containing 'crash': exit once, writing {graph}.crashed so the graph
+  succeeds when it is resubmitted after the restart
+- otherwise: reply OK
+"""
+import os
+import sys
+import time
+
+print('stand-in engine starting', flush=True)
+print('stand-in engine stderr', file=sys.stderr, flush=True)
+
+for line in sys.stdin:
+    xml_path = line.strip()
+    name = os.path.basename(xml_path)
+    if 'crash' in name and not os.path.exists(xml_path + '.crashed'):
+        open(xml_path + '.crashed', 'w').close()
+        os._exit(3)
+    if 'hang' in name:
+        time.sleep(600)
+    if 'fail' in name:
+        print('SNAP_ENGINE ERROR stand-in failure', flush=True)
+        continue
+    print(f'processing {xml_path}', flush=True)
+    print('SNAP_ENGINE OK 0.5', flush=True)
@@ -0,0 +1,144 @@
+import queue
+import logging
+import pytest
+import logging_utils
+from logging_utils import (
+    MAIN_SCENE, SceneFilter, RateLimitFilter, SceneFileHandler, LogListener,
+    setup_queue_logging, set_log_scene, end_log_scene)
+
+
+def make_record(msg, name='test', level=logging.INFO, **extra):
+    record = logging.makeLogRecord({
+        'name': name, 'msg': msg, 'levelno': level,
+        'levelname': logging.getLevelName(level)})
+    record.__dict__.update(extra)
+    return record
+
+
+@pytest.fixture
+def root_logger():
+    # restore the handlers and level of the root logger changed by the test
+    log = logging.getLogger()
+    handlers, level = log.handlers[:], log.level
+    yield log
+    for hdlr in log.handlers[:]:
+        log.removeHandler(hdlr)
+    for hdlr in handlers:
+        log.addHandler(hdlr)
+    log.setLevel(level)
+
+
+def test_scene_filter():
+    filt = SceneFilter('scene_a', logging.INFO)
+    record = make_record('a')
+    assert filt.filter(record)
+    assert record.scene == 'scene_a'
+    # records already tagged, e.g. by another process, keep their scene
+    record = make_record('b', scene='scene_b')
+    assert filt.filter(record)
+    assert record.scene == 'scene_b'
+    assert not filt.filter(make_record('c', level=logging.DEBUG))
+
+
+def test_rate_limit_filter(monkeypatch):
+    monkeypatch.setattr(logging_utils.time, 'monotonic', lambda: 100.0)
+    filt = RateLimitFilter(['pyroSAR'], rate=2)
+    # child loggers share the limit of the configured logger
+    assert filt.filter(make_record('1', name='pyroSAR.snap'))
+    assert filt.filter(make_record('2', name='pyroSAR.auxdata'))
+    assert not filt.filter(make_record('3', name='pyroSAR.snap'))
+    assert not filt.filter(make_record('4', name='pyroSAR'))
+    # other loggers and warnings are not limited
+    assert filt.filter(make_record('5', name='pyroSARx'))
+    assert filt.filter(make_record('6', name='pyroSAR', level=logging.WARNING))
+
+
+def test_rate_limit_filter_reports_suppressed(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(logging_utils.time, 'monotonic', lambda: now[0])
+    filt = RateLimitFilter(['pyroSAR', 'botocore'], rate=1)
+    # the first record of each logger passes, the others are dropped
+    for name in ['pyroSAR.snap', 'botocore', 'pyroSAR.snap', 'pyroSAR.auxdata', 'botocore']:
+        filt.filter(make_record('noise', name=name))
+    record = make_record('done')
+    assert filt.filter(record)
+    assert record.getMessage() == 'done (records suppressed: 2 from pyroSAR, 1 from botocore)'
+    # the counts are only reported once
+    record = make_record('next')
+    assert filt.filter(record)
+    assert record.getMessage() == 'next'
+    # a new window lets records through again
+    now[0] += 1
+    assert filt.filter(make_record('noise', name='pyroSAR'))
+
+
+def test_rate_limit_filter_disabled():
+    filt = RateLimitFilter(['pyroSAR'], rate=0)
+    assert all(filt.filter(make_record('noise', name='pyroSAR')) for _ in range(100))
+
+
+def test_scene_file_handler(tmp_path):
+    handler = SceneFileHandler(str(tmp_path))
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.handle(make_record('a1', scene='a'))
+    handler.handle(make_record('b1', scene='b'))
+    handler.handle(make_record('main', scene=MAIN_SCENE))
+    handler.close_scene('a')
+    # a late record does not reopen (and truncate) the closed log
+    handler.handle(make_record('a2', scene='a'))
+    handler.handle(make_record('b2', scene='b'))
+    handler.close()
+    assert (tmp_path / 'a.logs').read_text() == 'a1\n'
+    assert (tmp_path / 'b.logs').read_text() == 'b1\nb2\n'
+    assert not (tmp_path / f'{MAIN_SCENE}.logs').exists()
+
+
+def test_scene_file_handler_rerun(tmp_path):
+    (tmp_path / 'a.logs').write_text('previous run\n')
+    handler = SceneFileHandler(str(tmp_path))
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    handler.handle(make_record('a1', scene='a'))
+    handler.close()
+    assert (tmp_path / 'a.logs').read_text() == 'a1\n'
+
+
+def test_log_listener_close_scene(tmp_path, root_logger):
+    log_queue = queue.Queue()
+    listener = LogListener(log_queue, str(tmp_path))
+    listener.start()
+    try:
+        # as done by a worker for a scene
+        setup_queue_logging(log_queue)
+        set_log_scene('a', rate_limit=0)
+        logging.info('processing a')
+        logging.debug('not logged at info')
+        end_log_scene('a')
+        log_path = listener.close_scene('a', timeout=5)
+        assert log_path == str(tmp_path / 'a.logs')
+        # late records of a closed scene only go to the run log
+        logging.info('late record')
+    finally:
+        listener.stop()
+    scene_log = (tmp_path / 'a.logs').read_text()
+    assert 'processing a' in scene_log
+    assert 'not logged at info' not in scene_log
+    assert 'late record' not in scene_log
+    assert 'late record' in (tmp_path / 'run.logs').read_text()
+
+
+def test_log_listener_close_scene_timeout(tmp_path, root_logger):
+    log_queue = queue.Queue()
+    listener = LogListener(log_queue, str(tmp_path))
+    listener.start()
+    try:
+        setup_queue_logging(log_queue)
+        set_log_scene('a', rate_limit=0)
+        logging.info('processing a')
+        # the worker died before ending the scene, the log is closed anyway
+        listener.close_scene('a', timeout=0.5)
+        logging.info('late record')
+    finally:
+        listener.stop()
+    scene_log = (tmp_path / 'a.logs').read_text()
+    assert 'processing a' in scene_log
+    assert 'late record' not in scene_log
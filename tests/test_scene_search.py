@@ -0,0 +1,115 @@
+import json
+import logging
+import pytest
+from shapely import wkt
+import scene_search
+from scene_search import load_aoi, completed_scenes, record_completed, find_new_scenes
+
+BOX_A = {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}
+BOX_B = {'type': 'Polygon', 'coordinates': [[[1, 0], [2, 0], [2, 1], [1, 1], [1, 0]]]}
+
+
+@pytest.fixture
+def otf_cfg(tmp_path):
+    return {
+        'software': 'pyrosar',
+        'dem_type': 'glo_30',
+        'completion_ledger': str(tmp_path / 'completed_scenes.txt'),
+        'push_to_s3': True,
+        's3_bucket': 'bucket',
+        's3_bucket_folder': 'experimental',
+    }
+
+
+def write_json(path, obj):
+    path.write_text(json.dumps(obj))
+    return str(path)
+
+
+def test_load_aoi_wkt():
+    aoi = 'POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))'
+    assert wkt.loads(load_aoi(aoi)).equals(wkt.loads(aoi))
+
+
+def test_load_aoi_feature_collection(tmp_path):
+    path = write_json(tmp_path / 'aoi.geojson', {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'properties': {}, 'geometry': BOX_A},
+            {'type': 'Feature', 'properties': {}, 'geometry': BOX_B}]})
+    aoi = wkt.loads(load_aoi(path))
+    # the features are merged
+    assert aoi.geom_type == 'Polygon'
+    assert aoi.area == pytest.approx(2)
+
+
+def test_load_aoi_feature_and_geometry(tmp_path):
+    feature = write_json(tmp_path / 'feature.json', {'type': 'Feature', 'properties': {}, 'geometry': BOX_A})
+    geometry = write_json(tmp_path / 'geometry.geojson', BOX_B)
+    assert wkt.loads(load_aoi(feature)).area == pytest.approx(1)
+    assert wkt.loads(load_aoi(geometry)).bounds == (1, 0, 2, 1)
+
+
+def test_load_aoi_bad_input(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_aoi(str(tmp_path / 'missing.geojson'))
+    with pytest.raises(ValueError, match='not an existing file or a valid WKT'):
+        load_aoi('POLYGON ((0 0, 1 0')
+    with pytest.raises(ValueError):
+        load_aoi(str(tmp_path / 'missing_aoi'))
+
+
+def test_record_completed(otf_cfg):
+    record_completed(otf_cfg, 'scene_a')
+    record_completed(otf_cfg, 'scene_b')
+    with open(otf_cfg['completion_ledger']) as f:
+        assert f.read() == 'pyrosar/glo_30/scene_a\npyrosar/glo_30/scene_b\n'
+
+
+def test_record_completed_error(otf_cfg, tmp_path, caplog):
+    # the ledger path is a folder, writing fails without raising
+    otf_cfg['completion_ledger'] = str(tmp_path)
+    with caplog.at_level(logging.ERROR):
+        record_completed(otf_cfg, 'scene_a')
+    assert 'Failed to add scene_a to the completion ledger' in caplog.text
+
+
+def test_completed_scenes(otf_cfg, monkeypatch):
+    with open(otf_cfg['completion_ledger'], 'w') as f:
+        f.write('pyrosar/glo_30/scene_a\n'
+                'pyrosar/other_dem/scene_b\n'
+                'other_software/glo_30/scene_c\n')
+    prefixes = []
+
+    def list_bucket_files(bucket, prefix=''):
+        prefixes.append((bucket, prefix))
+        return [
+            f'{prefix}2024/scene_d/scene_d_timing.json',
+            f'{prefix}2024/scene_d/scene_d_rtc.tif',
+            f'{prefix}2024/scene_e/scene_e_rtc.tif']
+
+    monkeypatch.setattr(scene_search, 'list_bucket_files', list_bucket_files)
+    # only ledger entries for the same software and dem_type, and scenes
+    # with a timing file in the bucket are completed
+    assert completed_scenes(otf_cfg) == {'scene_a', 'scene_d'}
+    assert prefixes == [('bucket', 'experimental/pyrosar/glo_30/')]
+
+
+def test_completed_scenes_without_s3(otf_cfg, monkeypatch):
+    otf_cfg['push_to_s3'] = False
+    otf_cfg['completion_ledger'] = None
+
+    def list_bucket_files(bucket, prefix=''):
+        raise AssertionError('bucket should not be listed')
+
+    monkeypatch.setattr(scene_search, 'list_bucket_files', list_bucket_files)
+    assert completed_scenes(otf_cfg) == set()
+
+
+def test_find_new_scenes(otf_cfg, monkeypatch):
+    record_completed(otf_cfg, 'scene_b')
+    monkeypatch.setattr(scene_search, 'search_scenes', lambda cfg: ['scene_a', 'scene_b', 'scene_c', 'scene_d'])
+    monkeypatch.setattr(scene_search, 'list_bucket_files',
+                        lambda bucket, prefix='': [f'{prefix}scene_d_timing.json'])
+    # order of the search is kept
+    assert find_new_scenes(otf_cfg) == ['scene_a', 'scene_c']
@@ -0,0 +1,57 @@
+import os
+import sys
+import pytest
+from snap_engine import SnapEngine, SnapEngineError, jvm_config
+
+STANDIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snap_engine_standin.py')
+
+
+@pytest.fixture
+def engine():
+    with SnapEngine(command=[sys.executable, STANDIN]) as engine:
+        yield engine
+
+
+def test_cold_then_warm(engine, tmp_path):
+    assert engine.run(str(tmp_path / 'a.xml')) == (0.5, False)
+    assert engine.run(str(tmp_path / 'b.xml')) == (0.5, True)
+
+
+def test_graph_error(engine, tmp_path):
+    with pytest.raises(SnapEngineError, match='stand-in failure'):
+        engine.run(str(tmp_path / 'fail.xml'))
+    # the engine is still running and warm
+    assert engine.run(str(tmp_path / 'a.xml')) == (0.5, True)
+
+
+def test_restart_after_crash(engine, tmp_path):
+    assert engine.run(str(tmp_path / 'a.xml')) == (0.5, False)
+    # resubmitted on a new, cold engine
+    assert engine.run(str(tmp_path / 'crash.xml')) == (0.5, False)
+    assert engine.restarts == 1
+    assert engine.run(str(tmp_path / 'b.xml')) == (0.5, True)
+
+
+def test_crash_without_retries(tmp_path):
+    with SnapEngine(command=[sys.executable, STANDIN], retries=0) as engine:
+        with pytest.raises(SnapEngineError, match='crashed'):
+            engine.run(str(tmp_path / 'crash.xml'))
+
+
+def test_timeout(tmp_path):
+    with SnapEngine(command=[sys.executable, STANDIN], retries=1, timeout=2) as engine:
+        assert engine.run(str(tmp_path / 'a.xml')) == (0.5, False)
+        with pytest.raises(SnapEngineError, match='crashed 2 times'):
+            engine.run(str(tmp_path / 'hang.xml'))
+        assert engine.restarts == 1
+        # killed after the last attempt, restarted for the next graph
+        assert engine.run(str(tmp_path / 'b.xml')) == (0.5, False)
+        assert engine.restarts == 2
+
+
+def test_jvm_config():
+    java_options, max_mem, cache_size = jvm_config(
+        ['-J-Xmx16G', '-Djava.io.tmpdir=/data/tmp', '-c', '8G', '-q', '4'])
+    assert java_options == ['-Djava.io.tmpdir=/data/tmp', '-Dsnap.parallelism=4']
+    assert max_mem == '16G'
+    assert cache_size == 8 * 1024**3